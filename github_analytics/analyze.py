@@ -1,118 +1,300 @@
 import plotly.express as px
+import plotly.graph_objects as go
 import pandas as pd
+import numpy as np
+import bisect
 import collections
+import concurrent.futures
+import datetime
 import github
+import github.PullRequest
+import hashlib
 import os
+import pickle
 import re
+import threading
+import time
+import urllib3
 
 
 PRMeta = collections.namedtuple("PRMeta", "reviewers review_passes hours_to_merge total_changes")
 
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "github-analytics")
+OPEN_PR_CACHE_TTL = 300
 
-def _parse_pr_title_verb(pr):
-    verb = re.sub(r"\[[\w\-& ]+\] ", "", pr.title).lower().split(" ")[0]
-    verb = verb.replace(":", "")
-    if verb in ["adding", "added"]:
-        verb = "add"
-    if verb in ["fixing"]:
-        verb = "fix"
-    if verb in ["removing"]:
-        verb = "remove"
-    return verb
-
-
-def _cnt_pr_passes(reviews, commits, author):
-    events = [("review", review.submitted_at) for review in reviews if review.user != author] + [
-        ("commit", commit.commit.author.date) for commit in commits
-    ]
-    events.sort(key=lambda e: e[1])
-    last = "commit"
-    passes = 0
-    for evt_type, _ in events:
-        if last == "commit" and evt_type == "review":
-            passes += 1
-        last = evt_type
-    return passes
-
-
-def _get_pr_meta_info(pr):
-    requested_users = list(pr.get_review_requests()[0])
-    historical_reviews = list(pr.get_reviews())
-    reviewers = set(requested_users + [review.user for review in historical_reviews]) - set([pr.user])
-    review_passes = _cnt_pr_passes(historical_reviews, pr.get_commits(), pr.user)
+
+class _GithubRetry(urllib3.util.retry.Retry):
+    def is_retry(self, method, status_code, has_retry_after=False):
+        # secondary rate limits are 403s with Retry-After; other 403s (exhausted quota, SSO, scopes) are permanent
+        if status_code == 403:
+            return has_retry_after and self._is_method_retryable(method)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+GITHUB_RETRY = _GithubRetry(
+    total=5,
+    backoff_factor=2,
+    status_forcelist=(429, 502, 503),
+    allowed_methods=None,
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+PR_DF_COLUMNS = [
+    "number",
+    "user",
+    "title",
+    "merged_at",
+    "hours_to_merge",
+    "total_changes",
+    "review_passes",
+    "reviewers",
+]
+PR_DF_DTYPES = {"hours_to_merge": "float64", "total_changes": "int32", "review_passes": "int32"}
+
+PR_META_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $includeReviewRequests: Boolean!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      additions
+      deletions
+      reviewRequests(first: 100) @include(if: $includeReviewRequests) {
+        pageInfo { hasNextPage }
+        nodes { requestedReviewer { ... on User { login } } }
+      }
+      reviews(first: 100) {
+        pageInfo { hasNextPage }
+        nodes { submittedAt author { login } }
+      }
+      commits(first: 100) {
+        pageInfo { hasNextPage }
+        nodes { commit { authoredDate } }
+      }
+    }
+  }
+}
+"""
+
+_TITLE_PREFIX_RE = re.compile(r"\[[\w\-& ]+\] ")
+_VERB_ALIASES = {"adding": "add", "added": "add", "fixing": "fix", "removing": "remove"}
+
+
+def _parse_pr_title_verb(title):
+    verb = _TITLE_PREFIX_RE.sub("", title).lower().split(" ", 1)[0].replace(":", "")
+    return _VERB_ALIASES.get(verb, verb)
+
+
+def _cnt_pr_passes(review_times, commit_times):
+    return len({bisect.bisect_left(commit_times, review_time) for review_time in review_times})
+
+
+def _parse_github_datetime(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+
+
+def _get_hours_to_merge(pr):
     if pr.merged_at:
-        hours_to_merge = (pr.merged_at - pr.created_at).total_seconds() / (60 * 60)
-    else:
-        hours_to_merge = None
+        return (pr.merged_at - pr.created_at).total_seconds() / (60 * 60)
+    return None
+
+
+def _get_pr_meta_info_rest(pr, include_review_requests):
+    requested_users = list(pr.get_review_requests()[0]) if include_review_requests else []
+    historical_reviews = list(pr.get_reviews())
+    reviewer_logins = [user.login for user in requested_users] + [review.user.login for review in historical_reviews]
+    reviewers = set(reviewer_logins) - set([pr.user.login])
+    review_times = [review.submitted_at for review in historical_reviews if review.user != pr.user]
+    commit_times = sorted(commit.commit.author.date for commit in pr.get_commits())
+    review_passes = _cnt_pr_passes(review_times, commit_times)
     total_changes = pr.additions + pr.deletions
-    return PRMeta(reviewers, review_passes, hours_to_merge, total_changes)
+    return PRMeta(reviewers, review_passes, _get_hours_to_merge(pr), total_changes)
+
+
+def _get_pr_meta_info(pr, include_review_requests=True):
+    owner, name = pr.base.repo.full_name.split("/")
+    variables = {
+        "owner": owner,
+        "name": name,
+        "number": pr.number,
+        "includeReviewRequests": include_review_requests,
+    }
+    _, data = pr._requester.requestJsonAndCheck(
+        "POST", "/graphql", input={"query": PR_META_QUERY, "variables": variables}
+    )
+    if data.get("errors"):
+        raise RuntimeError("GraphQL query for PR #{} failed: {}".format(pr.number, data["errors"]))
+    pr_data = data["data"]["repository"]["pullRequest"]
+    connections = [pr_data[key] for key in ("reviewRequests", "reviews", "commits") if key in pr_data]
+    if any(conn["pageInfo"]["hasNextPage"] for conn in connections):
+        return _get_pr_meta_info_rest(pr, include_review_requests)
+    author = pr.user.login
+    reviewers = set()
+    for node in pr_data.get("reviewRequests", {}).get("nodes", []):
+        login = (node["requestedReviewer"] or {}).get("login")
+        if login:
+            reviewers.add(login)
+    review_times = []
+    for node in pr_data["reviews"]["nodes"]:
+        login = (node["author"] or {}).get("login")
+        if login:
+            reviewers.add(login)
+        if login != author and node["submittedAt"]:
+            review_times.append(_parse_github_datetime(node["submittedAt"]))
+    reviewers.discard(author)
+    commit_times = [_parse_github_datetime(node["commit"]["authoredDate"]) for node in pr_data["commits"]["nodes"]]
+    review_passes = _cnt_pr_passes(review_times, sorted(commit_times))
+    total_changes = pr_data["additions"] + pr_data["deletions"]
+    return PRMeta(reviewers, review_passes, _get_hours_to_merge(pr), total_changes)
+
+
+def _get_pr_meta_cache_path(cache_dir, repo_name, pr, include_review_requests):
+    key = "{}:{}:{}:{}".format(repo_name, pr.number, pr.updated_at.isoformat(), include_review_requests)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pkl")
+
+
+def _load_cached_pr_meta(path, pr):
+    try:
+        if pr.state != "closed" and time.time() - os.path.getmtime(path) > OPEN_PR_CACHE_TTL:
+            return None
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _save_cached_pr_meta(path, meta):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        pickle.dump(meta, f)
+    os.replace(tmp_path, path)
 
 
 class PRAnalyzer:
-    def __init__(self, repo, org, org_team, github_api_token=None):
+    def __init__(
+        self,
+        repo,
+        org,
+        org_team,
+        github_api_token=None,
+        max_workers=32,
+        cache_dir=DEFAULT_CACHE_DIR,
+        include_pending_reviewers=False,
+        since=None,
+        base="main",
+    ):
         if github_api_token is None:
             github_api_token = os.environ["GITHUB_API_TOKEN"]
-        self.github = github.Github(github_api_token)
+        self.github_api_token = github_api_token
         self.repo_name = repo
         self.org_name = org
         self.org_team_name = org_team
+        self.max_workers = max_workers
+        self.github = self._make_github()
+        self._thread_local = threading.local()
+        self.cache_dir = cache_dir
+        self.include_pending_reviewers = include_pending_reviewers
+        self.since = since
+        self.base = base
         self.repo = None
         self.org = None
         self.team = None
         self.team_users = None
+        self.team_logins = None
         self.prs = None
         self.valid_prs = None
         self.pr_to_meta = {}
+        self.pr_df = None
+        self._merged_df = None
+        self._changes_cache = None
 
     def download(self):
         self.repo = self.github.get_repo(self.repo_name)
         self.org = self.github.get_organization(self.org_name)
+        self._changes_cache = None
         self.team = [team for team in self.org.get_teams() if team.name == self.org_team_name][0]
         self.team_users = list(self.team.get_members())
-        self.prs = list(self.repo.get_pulls(state="all"))
-        self.valid_prs = [pr for pr in self.prs if pr.user in self.team_users and pr.base.label.endswith(":main")]
-        for pr in self.valid_prs:
-            self.pr_to_meta[pr] = _get_pr_meta_info(pr)
+        self.team_logins = frozenset(user.login for user in self.team_users)
+        self.prs = []
+        for pr in self.repo.get_pulls(state="all", sort="created", direction="desc", base=self.base):
+            if self.since is not None and pr.created_at < self.since:
+                break
+            self.prs.append(pr)
+        self.valid_prs = [pr for pr in self.prs if pr.user.login in self.team_logins]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            metas = executor.map(self._get_pr_meta_info_cached, self.valid_prs)
+            self.pr_to_meta = dict(zip(self.valid_prs, metas))
+        self.pr_df = self._build_pr_df()
+        self._merged_df = self.pr_df[self.pr_df.merged_at.notna()].copy()
 
-    def get_summary_stats(self):
-        pr_rows = []
-        for pr, meta in self.pr_to_meta.items():
-            if not pr.merged_at:
-                continue
-            pr_rows.append([meta.review_passes, meta.hours_to_merge, meta.total_changes, len(meta.reviewers)])
-        pr_df = pd.DataFrame(pr_rows, columns=["review_passes", "hours_to_merge", "total_changes", "num_reviewers"])
-        summary_rows = []
-        for col in pr_df.columns:
-            summary_rows.append(
-                [
-                    col,
-                    pr_df[col].mean(),
-                    pr_df[col].median(),
-                    pr_df[col].quantile(0.9),
-                    pr_df[col].min(),
-                    pr_df[col].max(),
-                ]
+    def _build_pr_df(self):
+        rows = [
+            (
+                pr.number,
+                pr.user.login,
+                pr.title,
+                pr.merged_at,
+                meta.hours_to_merge,
+                meta.total_changes,
+                meta.review_passes,
+                sorted(meta.reviewers),
             )
-        summary_df = pd.DataFrame(summary_rows, columns=["name", "mean", "median", "p90", "min", "max"]).set_index(
-            "name"
+            for pr, meta in self.pr_to_meta.items()
+        ]
+        pr_df = pd.DataFrame.from_records(rows, columns=PR_DF_COLUMNS).astype(PR_DF_DTYPES)
+        pr_df["user"] = pd.Categorical(pr_df.user, categories=sorted(self.team_logins))
+        return pr_df
+
+    def _make_github(self):
+        return github.Github(self.github_api_token, retry=GITHUB_RETRY)
+
+    def _get_thread_github(self):
+        if not hasattr(self._thread_local, "github"):
+            self._thread_local.github = self._make_github()
+        return self._thread_local.github
+
+    def _fetch_pr_meta_info(self, pr, include_review_requests):
+        # PyGithub's requester hands every thread the same connection object, so each worker
+        # rebinds the PR onto its own client before making requests
+        thread_pr = self._get_thread_github().create_from_raw_data(github.PullRequest.PullRequest, pr._rawData)
+        return _get_pr_meta_info(thread_pr, include_review_requests)
+
+    def _get_pr_meta_info_cached(self, pr):
+        include_review_requests = self.include_pending_reviewers or pr.state != "closed"
+        if self.cache_dir is None:
+            return self._fetch_pr_meta_info(pr, include_review_requests)
+        path = _get_pr_meta_cache_path(self.cache_dir, self.repo_name, pr, include_review_requests)
+        meta = _load_cached_pr_meta(path, pr)
+        if meta is None:
+            meta = self._fetch_pr_meta_info(pr, include_review_requests)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            _save_cached_pr_meta(path, meta)
+        return meta
+
+    def get_summary_stats(self):
+        pr_df = self._merged_df[["review_passes", "hours_to_merge", "total_changes"]].assign(
+            num_reviewers=self._merged_df.reviewers.map(len)
         )
+        summary_df = pr_df.agg(["mean", "median", "min", "max"]).T
+        summary_df.insert(2, "p90", pr_df.quantile(0.9))
+        summary_df.index.name = "name"
         return summary_df
 
     def plot_hours_to_merge_histogram(self, max_hours=120, bins=40):
-        hours_to_merge = [min(max_hours, self.pr_to_meta[pr].hours_to_merge) for pr in self.valid_prs if pr.merged_at]
-        df = pd.DataFrame({"hours_to_merge": hours_to_merge})
-        fig = px.histogram(
-            df,
-            x="hours_to_merge",
-            nbins=bins,
-            title="PR Hours To Merge ({})".format(self.org_team_name),
+        hours_to_merge = np.minimum(max_hours, self._merged_df.hours_to_merge.values)
+        fig = go.Figure(
+            go.Histogram(x=hours_to_merge, nbinsx=bins),
+            layout=dict(
+                title="PR Hours To Merge ({})".format(self.org_team_name),
+                xaxis_title="hours_to_merge",
+                yaxis_title="count",
+            ),
         )
+        df = pd.DataFrame({"hours_to_merge": hours_to_merge})
         return fig, df
 
     def plot_hours_to_merge_by_author_boxplot(self, max_hours=120):
-        hours_to_merge = [min(max_hours, self.pr_to_meta[pr].hours_to_merge) for pr in self.valid_prs if pr.merged_at]
-        usernames = [pr.user.login for pr in self.valid_prs if pr.merged_at]
-        df = pd.DataFrame({"hours_to_merge": hours_to_merge, "user": usernames})
+        df = self._merged_df[["hours_to_merge", "user"]].reset_index(drop=True)
+        df["hours_to_merge"] = df.hours_to_merge.clip(upper=max_hours)
         fig = px.box(
             df,
             x="hours_to_merge",
@@ -122,13 +304,7 @@ class PRAnalyzer:
         return fig, df
 
     def plot_reviewer_proportion_of_prs_pie(self):
-        pr_cnt_by_user = collections.defaultdict(int)
-        for _, meta in self.pr_to_meta.items():
-            for reviewer in meta.reviewers:
-                if reviewer not in self.team_users:
-                    continue
-                pr_cnt_by_user[reviewer.login] += 1
-        df = pd.DataFrame(pr_cnt_by_user.items(), columns=["reviewer", "prs"])
+        df = self._get_team_reviewer_df().groupby("reviewer", observed=True).size().reset_index(name="prs")
         fig = px.pie(
             df,
             values="prs",
@@ -137,21 +313,23 @@ class PRAnalyzer:
         )
         return fig, df
 
+    def _get_team_reviewer_df(self):
+        reviewer_df = self.pr_df.explode("reviewers").rename(columns={"reviewers": "reviewer"})
+        reviewer_df = reviewer_df[reviewer_df.reviewer.isin(self.team_logins)]
+        reviewers = pd.Categorical(reviewer_df.reviewer, categories=self.pr_df.user.cat.categories)
+        return reviewer_df.assign(reviewer=reviewers)
+
     def _get_changes_by_authors_and_reviewers(self):
-        pr_changes_by_author = collections.defaultdict(int)
-        for pr, meta in self.pr_to_meta.items():
-            pr_changes_by_author[pr.user.login] += meta.total_changes
-        pr_changes_by_reviewer = collections.defaultdict(int)
-        for _, meta in self.pr_to_meta.items():
-            for reviewer in meta.reviewers:
-                if reviewer not in self.team_users:
-                    continue
-                pr_changes_by_reviewer[reviewer.login] += meta.total_changes
-        return pr_changes_by_author, pr_changes_by_reviewer
+        if self._changes_cache is not None:
+            return self._changes_cache
+        pr_changes_by_author = self.pr_df.groupby("user", observed=True).total_changes.sum()
+        pr_changes_by_reviewer = self._get_team_reviewer_df().groupby("reviewer", observed=True).total_changes.sum()
+        self._changes_cache = (pr_changes_by_author, pr_changes_by_reviewer)
+        return self._changes_cache
 
     def plot_reviewer_proportion_of_changes_pie(self):
         _, pr_changes_by_reviewer = self._get_changes_by_authors_and_reviewers()
-        df = pd.DataFrame(pr_changes_by_reviewer.items(), columns=["reviewer", "changes"])
+        df = pr_changes_by_reviewer.reset_index(name="changes")
         fig = px.pie(
             df,
             values="changes",
@@ -162,7 +340,7 @@ class PRAnalyzer:
 
     def plot_author_proportion_of_changes_pie(self):
         pr_changes_by_author, _ = self._get_changes_by_authors_and_reviewers()
-        df = pd.DataFrame(pr_changes_by_author.items(), columns=["author", "changes"])
+        df = pr_changes_by_author.rename_axis("author").reset_index(name="changes")
         fig = px.pie(
             df,
             values="changes",
@@ -173,11 +351,8 @@ class PRAnalyzer:
 
     def plot_changes_reviewed_vs_created_scatter(self):
         pr_changes_by_author, pr_changes_by_reviewer = self._get_changes_by_authors_and_reviewers()
-        df_author = pd.DataFrame(pr_changes_by_author.items(), columns=["user", "changes_created"]).set_index("user")
-        df_reviewer = pd.DataFrame(pr_changes_by_reviewer.items(), columns=["user", "changes_reviewed"]).set_index(
-            "user"
-        )
-        df = df_author.join(df_reviewer).reset_index()
+        df_author = pr_changes_by_author.to_frame("changes_created")
+        df = df_author.join(pr_changes_by_reviewer.rename("changes_reviewed")).reset_index()
         mx_val = max(df.changes_reviewed.max(), df.changes_created.max())
         fig = px.scatter(
             df,
@@ -190,7 +365,7 @@ class PRAnalyzer:
         return fig, df
 
     def plot_pr_verb_pie(self, n=10):
-        cnts_of_verbs = collections.Counter([_parse_pr_title_verb(pr) for pr in self.valid_prs])
+        cnts_of_verbs = collections.Counter(self.pr_df.title.map(_parse_pr_title_verb))
         df = pd.DataFrame(cnts_of_verbs.most_common(n), columns=["word", "cnt"])
         fig = px.pie(
             df,
@@ -201,36 +376,31 @@ class PRAnalyzer:
         return fig, df
 
     def plot_hours_to_merge_user_heatmap(self, max_hours=120):
-        author_reviewer_hours_to_merge = collections.defaultdict(list)
-        for pr, meta in self.pr_to_meta.items():
-            if not pr.merged_at:
-                continue
-            for reviewer in meta.reviewers:
-                if reviewer not in self.team_users:
-                    continue
-                author_reviewer_hours_to_merge[(pr.user.login, reviewer.login)].append(
-                    min(max_hours, meta.hours_to_merge)
-                )
-        usernames = sorted([user.login for user in self.team_users])
+        reviewer_df = self._get_team_reviewer_df()
+        reviewer_df = reviewer_df[reviewer_df.merged_at.notna()]
+        reviewer_df = reviewer_df.assign(hours_to_merge=reviewer_df.hours_to_merge.clip(upper=max_hours))
+        author_reviewer_hours_to_merge = reviewer_df.groupby(["user", "reviewer"], observed=True).hours_to_merge.mean()
+        usernames = sorted(self.team_logins)
+        usernames_rev = usernames[::-1]
+        idx = {user: i for i, user in enumerate(usernames)}
+        ridx = {user: i for i, user in enumerate(usernames_rev)}
         heatmap = [[0] * len(usernames) for _ in range(len(usernames))]
-        for (author, reviewer), hours_to_merge in author_reviewer_hours_to_merge.items():
-            hours_to_merge_mean = sum(hours_to_merge) / len(hours_to_merge)
-            heatmap[usernames[::-1].index(author)][usernames.index(reviewer)] = hours_to_merge_mean
-        df = pd.DataFrame(heatmap, index=usernames[::-1], columns=usernames)
+        for (author, reviewer), hours_to_merge_mean in author_reviewer_hours_to_merge.items():
+            heatmap[ridx[author]][idx[reviewer]] = hours_to_merge_mean
+        df = pd.DataFrame(heatmap, index=usernames_rev, columns=usernames)
         fig = px.imshow(
             heatmap,
             x=usernames,
-            y=usernames[::-1],
+            y=usernames_rev,
             labels=dict(x="Reviewer", y="Author", color="Mean Hours To Merge"),
             title="PR Hours To Merge Heatmap ({})".format(self.org_team_name),
         )
         return fig, df
 
     def plot_changes_vs_hours_to_merge_scatter(self, max_hours=500):
-        hours_to_merge = [min(max_hours, self.pr_to_meta[pr].hours_to_merge) for pr in self.valid_prs if pr.merged_at]
-        changes = [self.pr_to_meta[pr].total_changes for pr in self.valid_prs if pr.merged_at]
-        users = [pr.user.login for pr in self.valid_prs if pr.merged_at]
-        df = pd.DataFrame({"hours_to_merge": hours_to_merge, "total_changes": changes, "author": users})
+        df = self._merged_df[["hours_to_merge", "total_changes", "user"]].rename(columns={"user": "author"})
+        df = df.reset_index(drop=True)
+        df["hours_to_merge"] = df.hours_to_merge.clip(upper=max_hours)
         fig = px.scatter(
             df,
             y="hours_to_merge",
@@ -241,28 +411,15 @@ class PRAnalyzer:
         return fig, df
 
     def plot_review_passes_by_author_boxplot(self):
-        passes = [self.pr_to_meta[pr].review_passes for pr in self.valid_prs if pr.merged_at]
-        users = [pr.user.login for pr in self.valid_prs if pr.merged_at]
-        df = pd.DataFrame({"review_passes": passes, "author": users})
+        df = self._merged_df[["review_passes", "user"]].rename(columns={"user": "author"}).reset_index(drop=True)
         fig = px.box(
             df, x="review_passes", color="author", title="Review Passes By Author ({})".format(self.org_team_name)
         )
         return fig, df
 
     def plot_review_passes_by_reviewer_boxplot(self):
-        passes = []
-        users = []
-        for pr, meta in self.pr_to_meta.items():
-            if not pr.merged_at:
-                continue
-            for reviewer in meta.reviewers:
-                if reviewer not in self.team_users:
-                    continue
-                passes.append(meta.review_passes)
-                users.append(reviewer.login)
-        passes = [self.pr_to_meta[pr].review_passes for pr in self.valid_prs if pr.merged_at]
-        users = [pr.user.login for pr in self.valid_prs if pr.merged_at]
-        df = pd.DataFrame({"review_passes": passes, "reviewer": users})
+        reviewer_df = self._get_team_reviewer_df()
+        df = reviewer_df.loc[reviewer_df.merged_at.notna(), ["review_passes", "reviewer"]].reset_index(drop=True)
         fig = px.box(
             df,
             x="review_passes",